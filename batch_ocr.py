@@ -1,6 +1,11 @@
 #!/usr/bin/env -S uv run --quiet --script
 # /// script
-# dependencies = []
+# dependencies = [
+#   "mlx-vlm>=0.0.9",
+#   "pillow>=10.0.0",
+#   "huggingface-hub>=0.20.0",
+#   "psutil>=5.9.0",
+# ]
 # ///
 
 """
@@ -18,39 +23,95 @@ Examples:
 """
 
 import argparse
-import subprocess
+import fnmatch
+import os
 import sys
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
+import psutil
 
-def process_file(input_file, output_dir, model, max_tokens):
-    """Process a single file with OCR"""
-    output_file = output_dir / f"{input_file.stem}_ocr.txt"
+from ocr import (
+    MAX_EDGE, MODEL_MAP, build_prompt, download_model, flush_logs, get_logger, is_reusable,
+    load_manifest, load_model, output_record, record_output, run_ocr, warm_up, write_atomic
+)
+
+logger = get_logger()
+
+
+# Approximate unified memory used by one worker (weights + activations)
+MODEL_MEMORY = {
+    "granite": 1 * 1024**3,
+    "nanonets": 4 * 1024**3,
+    "paddleocr": 3 * 1024**3,
+}
+
+# Cap on the MLX GPU buffer cache kept by each worker
+METAL_CACHE_LIMIT = 4 * 1024**3
+
+# Per-process model state, populated by _init_worker
+_model = None
+_processor = None
+_prompt = None
+_max_edge = None
+
+
+def _init_worker(model_name, model_path):
+    """Load and warm up the model once per worker process"""
+    import mlx.core as mx
+    
+    global _model, _processor, _prompt, _max_edge
+    _model, _processor = load_model(model_name, model_path)
+    _prompt = build_prompt(model_name)
+    _max_edge = MAX_EDGE[model_name]
+    
+    # Older MLX versions only expose the cache limit under mx.metal
+    set_cache_limit = getattr(mx, "set_cache_limit", None) or mx.metal.set_cache_limit
+    set_cache_limit(METAL_CACHE_LIMIT)
+    
+    # Pay kernel compilation cost here rather than on the first real file
+    warm_up(_model, _processor, _prompt)
+
+
+def max_workers_for(model_name, requested):
+    """Cap the worker count so every loaded model fits in available memory"""
+    # Each worker may also hold up to METAL_CACHE_LIMIT of cached MLX buffers
+    per_worker = MODEL_MEMORY[model_name] + METAL_CACHE_LIMIT
+    available = psutil.virtual_memory().available
+    return max(1, min(requested, available // per_worker))
+
+
+def output_path(input_file, output_dir):
+    """Return the OCR output path for an input image"""
+    return output_dir / f"{input_file.stem}_ocr.txt"
+
+
+def has_output(input_file, output_dir, model_name, full_precision, manifest):
+    """Check whether an input image already has OCR output from this model, weights and source"""
+    output_file = output_path(input_file, output_dir)
+    return is_reusable(output_file, output_record(input_file, model_name, full_precision), manifest)
+
+
+def process_file(input_file, output_dir, max_tokens):
+    """Process a single file with OCR using this process's loaded model"""
+    output_file = output_path(input_file, output_dir)
     
     try:
-        print(f"📄 Processing: {input_file.name}")
-        
-        cmd = [
-            "uv", "run", "ocr.py",
-            str(input_file),
-            "--model", model,
-            "--max-tokens", str(max_tokens),
-            "--output", str(output_file)
-        ]
+        logger.info(f"📄 Processing: {input_file.name}")
+        # Show which file is in progress before the (slow) OCR call blocks
+        flush_logs(logger)
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
+        result = run_ocr(
+            _model, _processor, input_file, _prompt, max_tokens=max_tokens, max_edge=_max_edge
         )
+        write_atomic(output_file, result)
         
-        print(f"✅ Completed: {input_file.name} -> {output_file.name}")
+        logger.info(f"✅ Completed: {input_file.name} -> {output_file.name}")
         return True, input_file.name
         
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Failed: {input_file.name} - {e}", file=sys.stderr)
+    except Exception as e:
+        logger.error(f"❌ Failed: {input_file.name} - {e}")
         return False, input_file.name
 
 
@@ -99,7 +160,19 @@ def main():
         "--workers",
         type=int,
         default=1,
-        help="Number of parallel workers (default: 1, recommended for MLX)"
+        help="Number of parallel worker processes, each with its own model (default: 1)"
+    )
+    
+    parser.add_argument(
+        "--full-precision",
+        action="store_true",
+        help="Use the original weights even if a quantized copy exists (see quantize.py)"
+    )
+    
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-process files that already have OCR output from the same model"
     )
     
     args = parser.parse_args()
@@ -107,7 +180,7 @@ def main():
     # Setup directories
     input_dir = Path(args.input_dir)
     if not input_dir.exists() or not input_dir.is_dir():
-        print(f"❌ Error: Directory not found: {args.input_dir}", file=sys.stderr)
+        logger.error(f"❌ Error: Directory not found: {args.input_dir}")
         sys.exit(1)
     
     if args.output_dir:
@@ -120,59 +193,120 @@ def main():
     # Find all matching files (images only, no PDFs)
     image_extensions = {'.png', '.jpg', '.jpeg', '.webp', '.gif', '.tiff', '.tif', '.bmp'}
     
-    if args.pattern == "*.*":
-        files = [f for f in input_dir.iterdir() if f.suffix.lower() in image_extensions]
+    if "/" in args.pattern:
+        # Patterns with a path component (e.g. "**/*.png") need a real glob
+        files = [f for f in input_dir.glob(args.pattern) if f.suffix.lower() in image_extensions]
     else:
-        files = list(input_dir.glob(args.pattern))
-        files = [f for f in files if f.suffix.lower() in image_extensions]
+        # Filter directory entries by name before building Path objects
+        with os.scandir(input_dir) as entries:
+            files = [
+                Path(entry.path) for entry in entries
+                if os.path.splitext(entry.name)[1].lower() in image_extensions
+                and fnmatch.fnmatchcase(entry.name, args.pattern)
+                and entry.is_file()
+            ]
     
     if not files:
-        print(f"❌ No files found matching pattern: {args.pattern}", file=sys.stderr)
+        logger.error(f"❌ No files found matching pattern: {args.pattern}")
         sys.exit(1)
     
-    print("🚀 Batch OCR Processing")
-    print("=" * 60)
-    print(f"📁 Input directory: {input_dir}")
-    print(f"📁 Output directory: {output_dir}")
-    print(f"🤖 Model: {args.model}")
-    print(f"📊 Files to process: {len(files)}")
-    print(f"👷 Workers: {args.workers}")
-    print("=" * 60)
+    # Skip files that already have OCR output from a previous run with the same model and weights
+    if not args.force:
+        manifest = load_manifest(output_dir)
+        pending = [
+            f for f in files
+            if not has_output(f, output_dir, args.model, args.full_precision, manifest)
+        ]
+        skipped = len(files) - len(pending)
+        files = pending
+    else:
+        skipped = 0
+    
+    logger.info("🚀 Batch OCR Processing")
+    logger.info("=" * 60)
+    logger.info(f"📁 Input directory: {input_dir}")
+    logger.info(f"📁 Output directory: {output_dir}")
+    logger.info(f"🤖 Model: {args.model}")
+    logger.info(f"📊 Files to process: {len(files)}")
+    if skipped:
+        logger.info(f"⏭️  Skipping {skipped} already processed files (use --force to redo)")
+    
+    workers = max_workers_for(args.model, args.workers)
+    if workers < args.workers:
+        logger.info(f"👷 Workers: {workers} (reduced from {args.workers} to fit in memory)")
+    else:
+        logger.info(f"👷 Workers: {workers}")
+    logger.info("=" * 60)
+    
+    if not files:
+        logger.info("✅ Nothing to do - all files already processed")
+        return
+    
+    # Download (or locate cached) weights once so workers load straight from disk
+    logger.info(f"🚀 Loading model: {args.model} ({MODEL_MAP[args.model]})")
+    flush_logs(logger)
+    model_path = download_model(args.model, args.full_precision)
     
     # Process files
     successful = 0
     failed = 0
+    aborted = False
     
-    if args.workers == 1:
-        # Sequential processing
-        for file in files:
-            success, filename = process_file(file, output_dir, args.model, args.max_tokens)
-            if success:
-                successful += 1
-            else:
-                failed += 1
-    else:
-        # Parallel processing (use with caution on Mac)
-        with ThreadPoolExecutor(max_workers=args.workers) as executor:
-            futures = {
-                executor.submit(process_file, file, output_dir, args.model, args.max_tokens): file
-                for file in files
-            }
-            
-            for future in as_completed(futures):
-                success, filename = future.result()
+    if workers == 1:
+        # Sequential processing - load the model once in this process
+        try:
+            _init_worker(args.model, model_path)
+        except Exception as e:
+            logger.error(f"❌ Failed to load model: {e}")
+            failed = len(files)
+            aborted = True
+        else:
+            for file in files:
+                success, filename = process_file(file, output_dir, args.max_tokens)
                 if success:
+                    record = output_record(file, args.model, args.full_precision)
+                    record_output(output_dir, output_path(file, output_dir), record)
                     successful += 1
                 else:
                     failed += 1
+    else:
+        # Parallel processing - each worker process loads its own model once
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(args.model, model_path),
+            ) as executor:
+                futures = {
+                    executor.submit(process_file, file, output_dir, args.max_tokens): file
+                    for file in files
+                }
+                
+                for future in as_completed(futures):
+                    success, filename = future.result()
+                    if success:
+                        file = futures[future]
+                        record = output_record(file, args.model, args.full_precision)
+                        record_output(output_dir, output_path(file, output_dir), record)
+                        successful += 1
+                    else:
+                        failed += 1
+        except BrokenProcessPool as e:
+            # A worker failed to load the model or died mid-run (e.g. out of memory)
+            logger.error(f"❌ Worker process failed: {e}")
+            failed = len(files) - successful
+            aborted = True
     
     # Summary
-    print("\n" + "=" * 60)
-    print("📊 Processing Complete!")
-    print(f"✅ Successful: {successful}")
-    print(f"❌ Failed: {failed}")
-    print(f"📁 Results saved to: {output_dir}")
-    print("=" * 60)
+    logger.info("\n" + "=" * 60)
+    logger.info("📊 Processing Complete!")
+    logger.info(f"✅ Successful: {successful}")
+    logger.info(f"❌ Failed: {failed}")
+    logger.info(f"📁 Results saved to: {output_dir}")
+    logger.info("=" * 60)
+    
+    if aborted:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -21,10 +21,287 @@ Examples:
 """
 
 import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import os
 import sys
+import time
 from pathlib import Path
 
 
+# Model mapping - Only verified working MLX models
+MODEL_MAP = {
+    "granite": "ibm-granite/granite-docling-258M-mlx",  # ✅ Verified working
+    "nanonets": "mlx-community/Nanonets-OCR2-3B-4bit",  # ✅ 4-bit quantized
+    "paddleocr": "NexaAI/paddle-ocr-mlx",  # ✅ 109 languages
+    "olmocr": "mlx-community/olmOCR-2-7B-1025-bf16",  # ✅ Large, high accuracy
+}
+
+# Default prompts per model
+# Note: <image> token is required for MLX-VLM
+DEFAULT_PROMPTS = {
+    "granite": "<image>\nConvert this page to markdown format.",
+    "nanonets": """<image>
+Extract the text from the above document as if you were reading it naturally. 
+Return tables in HTML format. Return equations in LaTeX. 
+If there's an image without a caption, add a description inside <img></img> tags.
+Use ☐ and ☑ for checkboxes.""",
+    "paddleocr": "<image>\nExtract all text from this document preserving the layout and structure.",
+    "olmocr": "<image>\nExtract all text from this document in markdown format with proper structure.",
+}
+
+# Longest image edge (in pixels) passed to each model's vision encoder
+MAX_EDGE = {
+    "granite": 1536,
+    "nanonets": 2048,
+    "paddleocr": 1280,
+    "olmocr": 1288,
+}
+
+# Where quantize.py stores 4-bit copies of the models
+QUANTIZED_DIR = Path.home() / ".cache" / "mlx-ocr"
+
+SUPPORTED_FORMATS = {'.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp', '.tiff', '.tif'}
+
+# Append-only log, per output directory, of which source and model produced each output
+MANIFEST_NAME = ".ocr_manifest.jsonl"
+
+# Loaded (model, processor) pairs keyed by model id or local path
+_MODEL_CACHE = {}
+
+# Chat-template formatted prompts keyed by (processor id, prompt)
+_PROMPT_CACHE = {}
+
+
+class _BufferedHandler(logging.handlers.MemoryHandler):
+    """MemoryHandler that writes all buffered lines to the target stream in one write
+    
+    Flushes when the buffer is full, on an error, or on the first record that
+    arrives more than `interval` seconds after the last flush. Bursts of quick
+    lines share one write; callers use flush_logs() before a long blocking step
+    so the line announcing it is not held back until the step finishes.
+    """
+    
+    def __init__(self, capacity, interval, **kwargs):
+        super().__init__(capacity, **kwargs)
+        self.interval = interval
+        self._last_flush = time.monotonic()
+    
+    def shouldFlush(self, record):
+        return (
+            super().shouldFlush(record)
+            or time.monotonic() - self._last_flush >= self.interval
+        )
+    
+    def flush(self):
+        with self.lock:
+            if self.target and self.buffer:
+                # StreamHandler.emit flushes per record, so format and write here instead
+                lines = [
+                    self.target.format(record) + self.target.terminator
+                    for record in self.buffer
+                    if self.target.filter(record)
+                ]
+                if lines:
+                    self.target.stream.write("".join(lines))
+                    self.target.stream.flush()
+                self.buffer.clear()
+            self._last_flush = time.monotonic()
+
+
+def get_logger(name="ocr"):
+    """Return a logger that batches progress output instead of writing each line to stdout"""
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    
+    # Info lines are buffered for stdout; an error flushes them, then goes to stderr
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.ERROR)
+    buffered = _BufferedHandler(1024, 1.0, flushLevel=logging.ERROR, target=stdout_handler)
+    
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.ERROR)
+    
+    logger.addHandler(buffered)
+    logger.addHandler(stderr_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    atexit.register(buffered.flush)
+    return logger
+
+
+def flush_logs(logger):
+    """Write out buffered log lines now, e.g. before a long blocking step"""
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def write_atomic(path, text):
+    """Write text to path via a temp file so a failed write never leaves a partial file"""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(text.encode("utf-8"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def output_record(source, model_name, full_precision=False):
+    """Describe what an output is made from: the source file (path and mtime), model and weights"""
+    source = Path(source).resolve()
+    weights = "q4" if local_quantized(model_name, full_precision) else "full"
+    return {
+        "source": str(source),
+        "mtime_ns": source.stat().st_mtime_ns,
+        "model": model_name,
+        "weights": weights,
+    }
+
+
+def load_manifest(output_dir):
+    """Return {output file name: record} from a directory's manifest ({} if there is none)"""
+    manifest = {}
+    try:
+        with open(Path(output_dir) / MANIFEST_NAME, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    manifest[entry.pop("output")] = entry
+                except (ValueError, KeyError, AttributeError):
+                    # e.g. a torn last line from an interrupted run
+                    continue
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def record_output(output_dir, output_file, record):
+    """Append a manifest entry saying which source and model produced output_file"""
+    # Start with a newline so a torn line from an interrupted run can't swallow this entry
+    with open(Path(output_dir) / MANIFEST_NAME, 'a', encoding="utf-8") as f:
+        f.write("\n" + json.dumps({"output": Path(output_file).name, **record}))
+
+
+def is_reusable(output_file, record, manifest):
+    """Check that output_file exists, is non-empty and was produced from record's source and model"""
+    output_file = Path(output_file)
+    return (
+        manifest.get(output_file.name) == record
+        and output_file.exists()
+        and output_file.stat().st_size > 0
+    )
+
+
+def build_prompt(model_name, custom_prompt=None):
+    """Return the prompt for a model, making sure it carries the <image> token"""
+    prompt = custom_prompt if custom_prompt else DEFAULT_PROMPTS[model_name]
+    
+    # Ensure prompt has <image> token (required for MLX-VLM)
+    if "<image>" not in prompt:
+        prompt = f"<image>\n{prompt}"
+    
+    return prompt
+
+
+def quantized_path(model_name, bits=4):
+    """Return the directory for a quantized copy of a model"""
+    return QUANTIZED_DIR / f"{model_name}-q{bits}"
+
+
+def local_quantized(model_name, full_precision=False):
+    """Return the quantized copy from quantize.py that would be used for a model, or None"""
+    path = quantized_path(model_name)
+    # A copy without config.json is incomplete (e.g. left by an older, interrupted quantize.py)
+    if not full_precision and (path / "config.json").exists():
+        return path
+    return None
+
+
+def download_model(model_name, full_precision=False):
+    """Return a local model directory, preferring a quantized copy from quantize.py"""
+    quantized = local_quantized(model_name, full_precision)
+    if quantized:
+        return quantized
+    
+    from huggingface_hub import snapshot_download
+    
+    return snapshot_download(repo_id=MODEL_MAP[model_name])
+
+
+def load_model(model_name, model_path=None):
+    """Load an MLX-VLM model and processor by short name, or from a local model_path"""
+    from mlx_vlm import load
+    
+    # Reuse models already loaded in this process (e.g. by batch_ocr or pdf_to_ocr)
+    source = str(model_path) if model_path else MODEL_MAP[model_name]
+    if source not in _MODEL_CACHE:
+        _MODEL_CACHE[source] = load(source)
+    return _MODEL_CACHE[source]
+
+
+def format_prompt(model, processor, prompt):
+    """Apply the model's chat template to a prompt, caching the result per processor"""
+    key = (id(processor), prompt)
+    if key not in _PROMPT_CACHE:
+        from mlx_vlm.prompt_utils import apply_chat_template
+        
+        # Remove <image> token from prompt (the chat template inserts it automatically)
+        text_prompt = prompt.replace("<image>", "").replace("\n\n", "\n").strip()
+        _PROMPT_CACHE[key] = apply_chat_template(processor, model.config, text_prompt, num_images=1)
+    return _PROMPT_CACHE[key]
+
+
+def prepare_image(image, max_edge):
+    """Open an image (path or PIL image), downscaling it if its longest edge exceeds max_edge"""
+    from PIL import Image, ImageOps
+    
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    # thumbnail() keeps the aspect ratio and never upscales smaller images
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return image
+
+
+def run_ocr(model, processor, image, prompt, max_tokens=4096, temperature=0.0, max_edge=None):
+    """Run OCR on a single image (path or PIL image) with an already loaded model"""
+    from mlx_vlm import generate
+    
+    formatted_prompt = format_prompt(model, processor, prompt)
+    
+    # Vision encoder cost grows quadratically with patch count, so cap the resolution
+    if max_edge:
+        image = prepare_image(image, max_edge)
+    elif isinstance(image, Path):
+        image = str(image)
+    
+    output = generate(
+        model,
+        processor,
+        prompt=formatted_prompt,
+        image=image,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        verbose=False,
+    )
+    
+    # Newer MLX-VLM versions return a GenerationResult, older ones a plain string
+    return getattr(output, "text", output).strip()
+
+
+def warm_up(model, processor, prompt):
+    """Run a 1-token generation on a blank image so Metal kernels are compiled up front"""
+    from PIL import Image
+    
+    run_ocr(model, processor, Image.new("RGB", (64, 64), "white"), prompt, max_tokens=1)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="OCR script optimized for Mac using MLX",
@@ -90,6 +367,12 @@ Note: PDFs not supported. Convert PDFs to images first:
         help="Save output to file instead of printing"
     )
     
+    parser.add_argument(
+        "--full-precision",
+        action="store_true",
+        help="Use the original weights even if a quantized copy exists (see quantize.py)"
+    )
+    
     args = parser.parse_args()
     
     # Verify image exists and is a supported format
@@ -99,10 +382,9 @@ Note: PDFs not supported. Convert PDFs to images first:
         sys.exit(1)
     
     # Check file extension
-    supported_formats = {'.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp', '.tiff', '.tif'}
-    if image_path.suffix.lower() not in supported_formats:
+    if image_path.suffix.lower() not in SUPPORTED_FORMATS:
         print(f"❌ Error: Unsupported file format: {image_path.suffix}", file=sys.stderr)
-        print(f"📝 Supported formats: {', '.join(sorted(supported_formats))}", file=sys.stderr)
+        print(f"📝 Supported formats: {', '.join(sorted(SUPPORTED_FORMATS))}", file=sys.stderr)
         if image_path.suffix.lower() == '.pdf':
             print(f"\n💡 Tip: PDFs are not directly supported by MLX-VLM.", file=sys.stderr)
             print(f"    Convert your PDF to images first:", file=sys.stderr)
@@ -110,33 +392,8 @@ Note: PDFs not supported. Convert PDFs to images first:
             print(f"    pdftoppm -png your.pdf output", file=sys.stderr)
         sys.exit(1)
     
-    # Model mapping - Only verified working MLX models
-    MODEL_MAP = {
-        "granite": "ibm-granite/granite-docling-258M-mlx",  # ✅ Verified working
-        "nanonets": "mlx-community/Nanonets-OCR2-3B-4bit",  # ✅ 4-bit quantized
-        "paddleocr": "NexaAI/paddle-ocr-mlx",  # ✅ 109 languages
-        "olmocr": "mlx-community/olmOCR-2-7B-1025-bf16",  # ✅ Large, high accuracy
-    }
-    
-    # Default prompts per model
-    # Note: <image> token is required for MLX-VLM
-    DEFAULT_PROMPTS = {
-        "granite": "<image>\nConvert this page to markdown format.",
-        "nanonets": """<image>
-Extract the text from the above document as if you were reading it naturally. 
-Return tables in HTML format. Return equations in LaTeX. 
-If there's an image without a caption, add a description inside <img></img> tags.
-Use ☐ and ☑ for checkboxes.""",
-        "paddleocr": "<image>\nExtract all text from this document preserving the layout and structure.",
-        "olmocr": "<image>\nExtract all text from this document in markdown format with proper structure.",
-    }
-    
     model_id = MODEL_MAP[args.model]
-    prompt = args.prompt if args.prompt else DEFAULT_PROMPTS[args.model]
-    
-    # Ensure prompt has <image> token (required for MLX-VLM)
-    if "<image>" not in prompt:
-        prompt = f"<image>\n{prompt}"
+    prompt = build_prompt(args.model, args.prompt)
     
     print(f"🚀 Loading model: {args.model} ({model_id})")
     print(f"📄 Processing: {args.image}")
@@ -144,50 +401,19 @@ Use ☐ and ☑ for checkboxes.""",
     print("=" * 60)
     
     try:
-        import subprocess
-        import json
+        model_path = download_model(args.model, args.full_precision)
+        model, processor = load_model(args.model, model_path)
         
-        # Use MLX-VLM's command-line interface which is more stable
-        # Remove <image> token from prompt for CLI (it handles it automatically)
-        cli_prompt = prompt.replace("<image>", "").replace("\n\n", "\n").strip()
-        
-        cmd = [
-            sys.executable, "-m", "mlx_vlm.generate",
-            "--model", model_id,
-            "--max-tokens", str(args.max_tokens),
-            "--temperature", str(args.temperature),
-            "--prompt", cli_prompt,
-            "--image", str(image_path),
-        ]
-        
-        # Run the command
-        result_process = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
+        result = run_ocr(
+            model,
+            processor,
+            image_path,
+            prompt,
+            max_tokens=args.max_tokens,
+            temperature=args.temperature,
+            max_edge=MAX_EDGE[args.model],
         )
         
-        # Extract the output and clean it up
-        output = result_process.stdout
-        
-        # Parse the output - the actual OCR text is between the ========== markers
-        if "==========" in output:
-            parts = output.split("==========")
-            if len(parts) >= 3:
-                # The generated text is in the middle section
-                result = parts[1].strip()
-                # Remove the prompt echo and extract only the assistant's response
-                if "<|start_of_role|>assistant<|end_of_role|>" in result:
-                    result = result.split("<|start_of_role|>assistant<|end_of_role|>")[1].strip()
-                # Remove trailing stats section if present
-                if "Prompt:" in result:
-                    result = result.split("\nPrompt:")[0].strip()
-            else:
-                result = output.strip()
-        else:
-            result = output.strip()
-        
         if args.output:
             output_path = Path(args.output)
             output_path.write_text(result, encoding="utf-8")
@@ -1,6 +1,10 @@
 #!/usr/bin/env -S uv run --quiet --script
 # /// script
-# dependencies = []
+# dependencies = [
+#   "mlx-vlm>=0.0.9",
+#   "pillow>=10.0.0",
+#   "huggingface-hub>=0.20.0",
+# ]
 # ///
 
 """
@@ -16,105 +20,243 @@ Examples:
 """
 
 import argparse
+import io
+import os
+import queue
 import subprocess
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import shutil
 
+from PIL import Image
+
+from ocr import (
+    MAX_EDGE, MODEL_MAP, build_prompt, download_model, flush_logs, get_logger, is_reusable,
+    load_manifest, load_model, output_record, record_output, run_ocr, write_atomic
+)
+
+logger = get_logger()
+
+
+# Rasterization resolution bounds; pages are rendered close to the model's input size
+DEFAULT_DPI = 150
+MIN_DPI = 72
+MAX_DPI = 200
+
 
 def check_poppler():
     """Check if poppler is installed"""
-    if not shutil.which("pdftoppm"):
-        print("❌ Error: poppler not installed", file=sys.stderr)
-        print("\n💡 Install it with:", file=sys.stderr)
-        print("   brew install poppler", file=sys.stderr)
+    if not shutil.which("pdftoppm") or not shutil.which("pdfinfo"):
+        logger.error("❌ Error: poppler not installed")
+        logger.error("\n💡 Install it with:")
+        logger.error("   brew install poppler")
         sys.exit(1)
 
 
-def convert_pdf_to_images(pdf_path, output_dir):
-    """Convert PDF to PNG images"""
-    print(f"📄 Converting PDF: {pdf_path.name}")
-    
-    # Create temp directory for images
-    temp_dir = output_dir / "temp_pages"
-    temp_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Convert PDF to images
-    base_name = temp_dir / pdf_path.stem
-    
+def get_pdf_info(pdf_path):
+    """Return the page count and first page size in points (width, height) using pdfinfo"""
     try:
         result = subprocess.run(
-            ["pdftoppm", "-png", "-r", "300", str(pdf_path), str(base_name)],
+            ["pdfinfo", str(pdf_path)],
             capture_output=True,
             text=True,
             check=True
         )
-        
-        # Find all generated images
-        images = sorted(temp_dir.glob(f"{pdf_path.stem}-*.png"))
-        
-        if not images:
-            print("❌ Error: No images generated from PDF", file=sys.stderr)
-            sys.exit(1)
-        
-        print(f"✅ Converted to {len(images)} pages")
-        return images
-        
     except subprocess.CalledProcessError as e:
-        print(f"❌ Error converting PDF: {e}", file=sys.stderr)
+        logger.error(f"❌ Error reading PDF: {e}")
         sys.exit(1)
+    
+    page_count = 0
+    page_size = None
+    for line in result.stdout.splitlines():
+        if line.startswith("Pages:"):
+            page_count = int(line.split()[1])
+        elif line.startswith("Page size:"):
+            # e.g. "Page size:      612 x 792 pts (letter)"
+            fields = line.split()
+            page_size = (float(fields[2]), float(fields[4]))
+    return page_count, page_size
+
+
+def choose_dpi(page_size, max_edge):
+    """Pick a DPI that renders the page's long edge at about max_edge pixels"""
+    if not page_size:
+        return DEFAULT_DPI
+    dpi = max_edge / (max(page_size) / 72)
+    return int(min(max(dpi, MIN_DPI), MAX_DPI))
+
+
+def rasterize_page(pdf_path, page, dpi):
+    """Render a single PDF page and return the PNG bytes from pdftoppm's stdout"""
+    # Without an output root pdftoppm writes the image to stdout
+    result = subprocess.run(
+        ["pdftoppm", "-png", "-r", str(dpi), "-f", str(page), "-l", str(page),
+         "-singlefile", str(pdf_path)],
+        capture_output=True,
+        check=True
+    )
+    return result.stdout
 
 
-def process_images(images, model, output_dir):
-    """Run OCR on all images"""
-    print(f"\n🚀 Processing {len(images)} pages with {model} model...")
-    print("=" * 60)
+def page_output_path(output_dir, pdf_path, page_num):
+    """Return the per-page markdown path for a page of a PDF"""
+    return output_dir / f"{pdf_path.stem}_page_{page_num}.md"
+
+
+def load_finished_pages(output_dir, pdf_path, page_count, record):
+    """Return {page_num: text} for pages a previous run saved from this PDF with this model"""
+    width = len(str(page_count))
+    manifest = load_manifest(output_dir)
+    finished = {}
+    for page in range(1, page_count + 1):
+        page_num = f"{page:0{width}d}"
+        output_file = page_output_path(output_dir, pdf_path, page_num)
+        if is_reusable(output_file, record, manifest):
+            finished[page_num] = output_file.read_text(encoding="utf-8")
+    return finished
+
+
+def convert_pdf_to_images(pdf_path, pages, page_count, page_queue, dpi, keep_dir=None):
+    """Render the given PDF pages in parallel, queueing (page_num, image) pairs in page order"""
+    # Zero-pad page numbers the same way pdftoppm does
+    width = len(str(page_count))
+    workers = os.cpu_count() or 1
+    
+    def queue_page(page, future):
+        page_num = f"{page:0{width}d}"
+        # Any failure drops only this page; the remaining pages still get converted
+        try:
+            png = future.result()
+            if keep_dir:
+                (keep_dir / f"{pdf_path.stem}-{page_num}.png").write_bytes(png)
+            
+            # Decode here so empty or corrupt pdftoppm output fails in this thread
+            image = Image.open(io.BytesIO(png))
+            image.load()
+        except subprocess.CalledProcessError as e:
+            logger.error(f"   ❌ Failed to convert page {page}: {e}")
+            if e.stderr:
+                logger.error(f"      {e.stderr.decode(errors='replace')[-500:].strip()}")
+            return
+        except Exception as e:
+            logger.error(f"   ❌ Failed to convert page {page}: {e}")
+            return
+        
+        page_queue.put((page_num, image))
+    
+    try:
+        # pdftoppm is single-threaded, so run one process per page across all cores.
+        # Only a small window of pages is in flight so rendered images don't pile up in memory.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for page in pages:
+                pending.append((page, executor.submit(rasterize_page, pdf_path, page, dpi)))
+                if len(pending) >= 2 * workers:
+                    queue_page(*pending.popleft())
+            
+            while pending:
+                queue_page(*pending.popleft())
+    finally:
+        # Always signal the consumer that no more pages are coming
+        page_queue.put(None)
+
+
+def write_pages(write_queue, output_dir, record):
+    """Write (path, text) items from the queue to disk until a None sentinel arrives"""
+    while (item := write_queue.get()) is not None:
+        output_file, text = item
+        # A failed write is logged and skipped; the thread keeps draining the queue
+        try:
+            write_atomic(output_file, text)
+            record_output(output_dir, output_file, record)
+            logger.info(f"   💾 Saved {output_file.name}")
+        except Exception as e:
+            logger.error(f"   ❌ Failed to save {output_file.name}: {e}")
+
+
+def process_images(page_queue, page_count, model, output_dir, pdf_path, record,
+                   save_pages=False, full_precision=False):
+    """Run OCR on pages as they arrive on the queue, loading the model only once"""
+    logger.info(f"\n🚀 Processing {page_count} pages with {model} model...")
+    logger.info("=" * 60)
+    
+    # The model is loaded on the first page that actually needs OCR
+    ocr_model = processor = None
+    prompt = build_prompt(model)
+    
+    # Per-page files are written by a background thread so OCR never waits on disk
+    if save_pages:
+        write_queue = queue.Queue()
+        writer = threading.Thread(
+            target=write_pages, args=(write_queue, output_dir, record), daemon=True
+        )
+        writer.start()
     
     results = []
+    i = 0
     
-    for i, image in enumerate(images, 1):
-        page_num = image.stem.split('-')[-1]
-        output_file = output_dir / f"page_{page_num}.md"
+    while (item := page_queue.get()) is not None:
+        i += 1
+        page_num, image = item
+        
+        output_file = page_output_path(output_dir, pdf_path, page_num)
         
-        print(f"📄 Page {i}/{len(images)}: {image.name}")
+        logger.info(f"📄 Page {i}/{page_count} (page {int(page_num)})")
+        # Show which page is in progress before the (slow) OCR call blocks
+        flush_logs(logger)
         
         try:
-            subprocess.run(
-                ["uv", "run", "ocr.py", str(image), "--model", model, "--output", str(output_file)],
-                capture_output=True,
-                text=True,
-                check=True
-            )
+            if ocr_model is None:
+                logger.info(f"   🚀 Loading model: {MODEL_MAP[model]}")
+                flush_logs(logger)
+                ocr_model, processor = load_model(model, download_model(model, full_precision))
             
-            results.append((page_num, output_file))
-            print(f"   ✅ Saved to {output_file.name}")
+            text = run_ocr(ocr_model, processor, image, prompt, max_edge=MAX_EDGE[model])
+            results.append((page_num, text))
             
-        except subprocess.CalledProcessError as e:
-            print(f"   ❌ Failed: {e}", file=sys.stderr)
+            logger.info(f"   ✅ Done ({len(text)} characters)")
+            if save_pages:
+                write_queue.put((output_file, text))
+            
+        except Exception as e:
+            logger.error(f"   ❌ Failed: {e}")
+    
+    if save_pages:
+        write_queue.put(None)
+        writer.join()
     
     return results
 
 
-def create_combined_output(results, output_dir, pdf_name):
-    """Combine all pages into one file"""
+def create_combined_output(results, output_dir, pdf_name, page_count):
+    """Combine all pages into one file, returning None if no page succeeded"""
+    if not results:
+        logger.error("\n❌ No pages were processed successfully - skipping combined output")
+        return None
+    
     combined_file = output_dir / f"{pdf_name}_complete.md"
     
-    print(f"\n📝 Creating combined output: {combined_file.name}")
+    logger.info(f"\n📝 Creating combined output: {combined_file.name}")
     
-    with open(combined_file, 'w', encoding='utf-8') as outfile:
-        outfile.write(f"# OCR Results: {pdf_name}\n\n")
-        outfile.write(f"Total Pages: {len(results)}\n\n")
-        outfile.write("=" * 60 + "\n\n")
-        
-        for page_num, result_file in results:
-            outfile.write(f"## Page {page_num}\n\n")
-            
-            if result_file.exists():
-                content = result_file.read_text(encoding='utf-8')
-                outfile.write(content)
-                outfile.write("\n\n" + "=" * 60 + "\n\n")
+    separator = "\n\n" + "=" * 60 + "\n\n"
     
-    print(f"✅ Combined file created: {combined_file}")
+    # One buffered handle for the whole document; pages are appended as bytes
+    with open(combined_file, 'wb', buffering=1 << 20) as outfile:
+        outfile.write(
+            (f"# OCR Results: {pdf_name}\n\n"
+             f"Total Pages: {page_count}\n\n"
+             + (f"Processed Pages: {len(results)}\n\n" if len(results) < page_count else "")
+             + "=" * 60 + "\n\n").encode("utf-8")
+        )
+        for page_num, text in results:
+            outfile.write(f"## Page {page_num}\n\n{text}{separator}".encode("utf-8"))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    
+    logger.info(f"✅ Combined file created: {combined_file}")
     return combined_file
 
 
@@ -145,10 +287,35 @@ def main():
         help="Output directory (default: <pdf_name>_ocr/)"
     )
     
+    parser.add_argument(
+        "--dpi",
+        type=int,
+        default=None,
+        help="Rasterization DPI (default: chosen from page size to match the model's input size)"
+    )
+    
     parser.add_argument(
         "--keep-images",
         action="store_true",
-        help="Keep temporary PNG images"
+        help="Also save the rendered page images to <output_dir>/temp_pages/"
+    )
+    
+    parser.add_argument(
+        "--save-pages",
+        action="store_true",
+        help="Also save each page to its own <pdf_name>_page_*.md file"
+    )
+    
+    parser.add_argument(
+        "--full-precision",
+        action="store_true",
+        help="Use the original weights even if a quantized copy exists (see quantize.py)"
+    )
+    
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-run OCR on pages saved by a previous --save-pages run with the same model"
     )
     
     args = parser.parse_args()
@@ -159,11 +326,11 @@ def main():
     # Verify PDF exists
     pdf_path = Path(args.pdf_file)
     if not pdf_path.exists():
-        print(f"❌ Error: PDF not found: {args.pdf_file}", file=sys.stderr)
+        logger.error(f"❌ Error: PDF not found: {args.pdf_file}")
         sys.exit(1)
     
     if pdf_path.suffix.lower() != '.pdf':
-        print(f"❌ Error: Not a PDF file: {args.pdf_file}", file=sys.stderr)
+        logger.error(f"❌ Error: Not a PDF file: {args.pdf_file}")
         sys.exit(1)
     
     # Setup output directory
@@ -174,37 +341,68 @@ def main():
     
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    print("🎯 PDF to OCR Pipeline")
-    print("=" * 60)
-    print(f"📁 PDF: {pdf_path.name}")
-    print(f"🤖 Model: {args.model}")
-    print(f"📁 Output: {output_dir}")
-    print("=" * 60)
-    print()
+    logger.info("🎯 PDF to OCR Pipeline")
+    logger.info("=" * 60)
+    logger.info(f"📁 PDF: {pdf_path.name}")
+    logger.info(f"🤖 Model: {args.model}")
+    logger.info(f"📁 Output: {output_dir}")
+    logger.info("=" * 60)
+    logger.info("")
     
-    # Convert PDF to images
-    images = convert_pdf_to_images(pdf_path, output_dir)
+    page_count, page_size = get_pdf_info(pdf_path)
+    if not page_count:
+        logger.error("❌ Error: No pages found in PDF")
+        sys.exit(1)
     
-    # Process all images
-    results = process_images(images, args.model, output_dir)
+    dpi = args.dpi or choose_dpi(page_size, MAX_EDGE[args.model])
+    logger.info(f"📄 Converting PDF: {pdf_path.name} ({page_count} pages at {dpi} DPI)")
     
-    # Create combined output
-    combined_file = create_combined_output(results, output_dir, pdf_path.stem)
+    # Reuse pages saved by an earlier run of this PDF with the same model and weights;
+    # only the remaining pages are rasterized and OCR'd
+    record = output_record(pdf_path, args.model, args.full_precision)
+    finished = {} if args.force else load_finished_pages(output_dir, pdf_path, page_count, record)
+    width = len(str(page_count))
+    pages = [p for p in range(1, page_count + 1) if f"{p:0{width}d}" not in finished]
+    if finished:
+        logger.info(f"⏭️  Reusing {len(finished)} pages from a previous run (use --force to redo)")
+    
+    # Page images are kept in memory unless explicitly requested on disk
+    keep_dir = None
+    if args.keep_images:
+        keep_dir = output_dir / "temp_pages"
+        keep_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Rasterize pages in the background so OCR can start on page 1 right away
+    # The queue is bounded so rendering stays only a few pages ahead of OCR
+    page_queue = queue.Queue(maxsize=4)
+    converter = threading.Thread(
+        target=convert_pdf_to_images,
+        args=(pdf_path, pages, page_count, page_queue, dpi, keep_dir),
+        daemon=True
+    )
+    converter.start()
     
-    # Cleanup temp images
-    if not args.keep_images:
-        temp_dir = output_dir / "temp_pages"
-        if temp_dir.exists():
-            shutil.rmtree(temp_dir)
-            print(f"🧹 Cleaned up temporary images")
+    # Process pages as they are converted
+    results = process_images(
+        page_queue, len(pages), args.model, output_dir, pdf_path, record,
+        args.save_pages, args.full_precision
+    )
+    converter.join()
+    results = sorted(list(finished.items()) + results)
+    
+    # Create combined output
+    combined_file = create_combined_output(results, output_dir, pdf_path.stem, page_count)
+    if combined_file is None:
+        sys.exit(1)
     
     # Summary
-    print("\n" + "=" * 60)
-    print("🎉 Processing Complete!")
-    print(f"✅ Processed: {len(results)} pages")
-    print(f"📄 Individual pages: {output_dir}/page_*.md")
-    print(f"📚 Combined file: {combined_file}")
-    print("=" * 60)
+    logger.info("\n" + "=" * 60)
+    logger.info("🎉 Processing Complete!")
+    logger.info(f"✅ Processed: {len(results)}/{page_count} pages")
+    if args.save_pages:
+        logger.info(f"📄 Individual pages: {output_dir}/{pdf_path.stem}_page_*.md")
+    logger.info(f"📚 Combined file: {combined_file}")
+    logger.info("=" * 60)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+#!/usr/bin/env -S uv run --quiet --script
+# /// script
+# dependencies = [
+#   "mlx-vlm>=0.0.9",
+#   "pillow>=10.0.0",
+#   "huggingface-hub>=0.20.0",
+# ]
+# ///
+
+"""
+Quantize OCR models to 4-bit for faster inference on Apple Silicon
+Quantized copies are saved to ~/.cache/mlx-ocr/ and used automatically by
+ocr.py, batch_ocr.py and pdf_to_ocr.py (pass --full-precision to opt out)
+
+Usage:
+    uv run quantize.py [--model MODEL] [--force]
+
+Examples:
+    uv run quantize.py
+    uv run quantize.py --model paddleocr
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+
+from ocr import MODEL_MAP, download_model, local_quantized, quantized_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Quantize an OCR model to 4-bit with MLX-VLM",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="granite",
+        choices=["granite", "nanonets", "paddleocr", "olmocr"],
+        help="Model to quantize (default: granite)"
+    )
+    
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Overwrite an existing quantized copy"
+    )
+    
+    args = parser.parse_args()
+    
+    output_path = quantized_path(args.model)
+    if local_quantized(args.model) and not args.force:
+        print(f"✅ Already quantized: {output_path}")
+        print("💡 Use --force to rebuild it")
+        return
+    
+    print(f"📥 Fetching model: {args.model} ({MODEL_MAP[args.model]})")
+    model_path = Path(download_model(args.model, full_precision=True))
+    
+    # Some models (e.g. nanonets) are published pre-quantized
+    config = json.loads((model_path / "config.json").read_text(encoding="utf-8"))
+    if "quantization" in config:
+        print(f"✅ {args.model} is already quantized upstream - nothing to do")
+        return
+    
+    try:
+        from mlx_vlm import convert
+    except ImportError:
+        # Older MLX-VLM versions keep convert in utils
+        from mlx_vlm.utils import convert
+    
+    print(f"⚙️  Quantizing to 4-bit: {output_path}")
+    
+    # Convert into a temp directory and move it into place only once it is complete,
+    # so an interrupted run never leaves a half-written copy the OCR scripts would pick up
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        convert(
+            str(model_path),
+            mlx_path=str(tmp_path),
+            quantize=True,
+            q_group_size=64,
+            q_bits=4,
+        )
+        # Replace any previous or incomplete copy
+        shutil.rmtree(output_path, ignore_errors=True)
+        os.replace(tmp_path, output_path)
+    except Exception as e:
+        print(f"\n❌ Error during quantization: {e}", file=sys.stderr)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        sys.exit(1)
+    except BaseException:
+        # e.g. Ctrl-C while the weights are being saved
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    
+    print(f"✅ Quantized model saved to: {output_path}")
+    print("💡 The OCR scripts now use it automatically (--full-precision to opt out)")
+
+
+if __name__ == "__main__":
+    main()
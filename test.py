@@ -16,18 +16,31 @@ from pathlib import Path
 import requests
 
 
+# Shared HTTP session so repeated downloads reuse the connection
+session = requests.Session()
+
+
 def download_sample_image():
     """Download a sample document image for testing"""
+    sample_path = Path("sample_document.png")
+    if sample_path.exists():
+        print(f"✅ Using existing sample: {sample_path}")
+        return sample_path
+    
     print("📥 Downloading sample document...")
     
     # Sample document from HuggingFace
     url = "https://huggingface.co/datasets/merve/vlm_test_images/resolve/main/throughput_smolvlm.png"
     
-    response = requests.get(url)
-    response.raise_for_status()
-    
-    sample_path = Path("sample_document.png")
-    sample_path.write_bytes(response.content)
+    # Stream to disk instead of buffering the whole response in memory;
+    # write to a .part file first so an interrupted download isn't reused
+    partial_path = sample_path.with_name(sample_path.name + ".part")
+    with session.get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        with open(partial_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+    partial_path.replace(sample_path)
     
     print(f"✅ Downloaded: {sample_path}")
     return sample_path